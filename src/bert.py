@@ -5,6 +5,9 @@ assessing BERT's syntactic abilities: https://github.com/yoavg/bert-syntax/
 Thanks to Yoav for making his code available.
 
 """
+from functools import cached_property
+
+import numpy as np
 import pandas as pd
 import torch
 from torch import LongTensor  # pylint: disable=E0611
@@ -14,12 +17,18 @@ from constants import MASK
 
 START = ["[CLS]"]
 END = ["[SEP]"]
+BATCH_SIZE = 64  # number of sentences per forward pass
+MAX_LENGTH = 512  # longest input BERT accepts, in tokens
+BUCKET_SIZE = 32  # on GPU, inputs are padded to a multiple of this many tokens
+WARMUP_STEPS = 3  # forward passes to run before capturing a CUDA graph
 
 
 class BERT:
     """High-level interface for getting word predictions from BERT."""
 
-    def __init__(self, name, gpu=False):
+    def __init__(
+        self, name, gpu=False, batch_size=BATCH_SIZE, quantize=False, bf16=False
+    ):
         """Initialize BERT instance.
 
         Parameters
@@ -29,21 +38,85 @@ class BERT:
             'bert-base-multilingual-cased' or 'bert-base-cased'
         cpu : bool
             Whether to run on GPU or not (useful for debugging)
+        batch_size : int
+            Maximum number of sentences in a single forward pass
+        quantize : bool
+            Whether to quantize the model's linear layers to int8 when running
+            on CPU. This is several times faster, but changes probabilities by
+            around 1e-2, so it's off by default
+        bf16 : bool
+            Whether to run in bfloat16 rather than float16 on GPU. It's as fast
+            on GPUs that support it, and has float32's range so can't overflow
 
         """
         self.model = BertForMaskedLM.from_pretrained(name)
         self.gpu = gpu
         if self.gpu:
-            self.model = self.model.cuda()
+            # half precision roughly doubles throughput on tensor-core GPUs
+            dtype = torch.bfloat16 if bf16 else torch.float16
+            self.model = self.model.cuda().to(dtype=dtype)
+        elif quantize:
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
         self.model = self.model.eval()
-        tokenizer = BertTokenizer.from_pretrained(name)
-        self.tokenize = tokenizer.tokenize
-        self.tokens_to_ids = tokenizer.convert_tokens_to_ids
-        self.ids_to_tokens = tokenizer.ids_to_tokens
+        self._logits = self._masked_logits
+        if self.gpu and hasattr(torch, "compile"):  # only in PyTorch 2 onwards
+            # fuses kernels. We capture CUDA graphs ourselves (see `_graph()`),
+            # so we stick to the default mode. Compilation happens lazily.
+            self._logits = torch.compile(self._masked_logits)
+        self._graphs = {}  # captured CUDA graphs, keyed by input shape
+        if self.gpu:
+            # all graphs share one memory pool, rather than one pool each
+            self._graph_pool = torch.cuda.graph_pool_handle()
+        self.tokenizer = BertTokenizer.from_pretrained(name)
+        self.tokenize = self.tokenizer.tokenize
+        self.tokens_to_ids = self.tokenizer.convert_tokens_to_ids
+        self.pad_id = self.tokenizer.pad_token_id
+        # inputs are assembled in buffers allocated once up front. On GPU they
+        # live in pinned memory so that copies to the device are asynchronous.
+        self.batch_size = batch_size
+        size = batch_size * MAX_LENGTH
+        self._input_ids = torch.empty(size, dtype=torch.long, pin_memory=gpu)
+        self._attention_mask = torch.empty(size, dtype=torch.long, pin_memory=gpu)
+        self._target_indices = torch.empty(batch_size, dtype=torch.long, pin_memory=gpu)
+
+    @cached_property
+    def vocab(self):
+        """Return BERT's vocab in order of token id."""
         # tokenizer.vocab is a collections.OrderedDict, not a regular Python
         # dictionary, so its keys always come out in the same order.
-        self.vocab = list(tokenizer.vocab.keys())
-        self.index = pd.Index(self.vocab, name="word")
+        return list(self.tokenizer.vocab.keys())
+
+    @cached_property
+    def index(self):
+        """pd.Index: BERT's vocab, used to label predictions."""
+        return pd.Index(self.vocab, name="word")
+
+    @cached_property
+    def _folding(self):
+        """Work out which vocab entries get merged when case-folding.
+
+        We do this once, so that folding a prediction is a single scatter-add
+        on the model's device rather than a groupby.
+
+        Returns
+        -------
+        torch.Tensor
+            Position in the folded vocab of each entry in the vocab
+        torch.Tensor
+            Number of vocab entries merged into each folded vocab entry
+        pd.Index
+            The folded vocab
+
+        """
+        lowered = np.array([word.lower() for word in self.vocab], dtype=object)
+        folded, inverse = np.unique(lowered, return_inverse=True)
+        counts = np.bincount(inverse)
+        device = self.model.device
+        inverse = torch.as_tensor(inverse, dtype=torch.long, device=device)
+        counts = torch.as_tensor(counts, dtype=torch.float, device=device)
+        return inverse, counts, pd.Index(folded, name="word")
 
     def predict(self, masked_sentence, fold_case=False):
         """Predict the masked word in `masked_sentence`.
@@ -64,17 +137,277 @@ class BERT:
             each word in the masked position.
 
         """
-        tokens = START + self.tokenize(masked_sentence) + END
+        return self.predict_batch([masked_sentence], fold_case)[0]
+
+    def predict_batch(self, masked_sentences, fold_case=False):
+        """Predict the masked word in each of `masked_sentences`.
+
+        Sentences are sorted by length before being split into batches so that
+        each batch needs as little padding as possible. Raises ValueError if
+        any of the sentences doesn't contain MASK.
+
+        Parameters
+        ----------
+        masked_sentences : list of str
+            Sentences with one token masked out
+        fold_case : bool
+            Whether or not to average predictions over different casings.
+
+        Returns
+        -------
+        list of pd.DataFrame
+            The unnormalized probability distributions, in the same order as
+            `masked_sentences`.
+
+        """
+        encoded = [self._encode(sentence) for sentence in masked_sentences]
+        return self._predict_encoded(encoded, fold_case)
+
+    def _predict_encoded(self, encoded, fold_case):
+        """Return the prediction for each encoded sentence, as a DataFrame."""
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i][0]))
+        result = [None] * len(encoded)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            probs = self._forward([encoded[i] for i in batch], fold_case=fold_case)
+            for i, row in zip(batch, probs.numpy()):
+                result[i] = self._to_frame(row, fold_case)
+        return result
+
+    def predict_words(self, masked_sentence, words, fold_case=False):
+        """Predict how likely each of `words` is in the masked position.
+
+        This is like `predict()`, but when we only care about a few words it
+        saves building and copying off the GPU a prediction for the whole
+        vocab.
+
+        Parameters
+        ----------
+        masked_sentence : str
+            Sentence with one token masked out
+        words : list of str
+            Words to get predictions for
+        fold_case : bool
+            Whether or not to average predictions over different casings.
+
+        Returns
+        -------
+        np.ndarray
+            The unnormalized probability of each of `words`, or NaN if the
+            word isn't in BERT's vocab.
+
+        """
+        return self.predict_words_batch([masked_sentence], words, fold_case)[0]
+
+    def predict_words_batch(self, masked_sentences, words, fold_case=False):
+        """Predict how likely each of `words` is in each of `masked_sentences`.
+
+        Only the logits of `words` are gathered on the model's device, so
+        that's all that gets copied back. Sentences are batched as in
+        `predict_batch()`.
+
+        Parameters
+        ----------
+        masked_sentences : list of str
+            Sentences with one token masked out
+        words : list of str
+            Words to get predictions for
+        fold_case : bool
+            Whether or not to average predictions over different casings.
+
+        Returns
+        -------
+        np.ndarray
+            The unnormalized probability of each of `words` (columns) in each
+            of `masked_sentences` (rows), or NaN if the word isn't in BERT's
+            vocab.
+
+        """
+        encoded = [self._encode(sentence) for sentence in masked_sentences]
+        return self._predict_words_encoded(encoded, words, fold_case)
+
+    def predict_words_tokens_batch(self, masked_tokens, words, fold_case=False):
+        """Predict how likely each of `words` is in each of `masked_tokens`.
+
+        This is like `predict_words_batch()` for sentences that have already
+        been tokenized with `tokenize()`, which saves tokenizing them twice
+        when the tokens are needed anyway (e.g. to check the sentence's
+        length).
+
+        Parameters
+        ----------
+        masked_tokens : list of list of str
+            Tokenized sentences with one token masked out
+        words : list of str
+            Words to get predictions for
+        fold_case : bool
+            Whether or not to average predictions over different casings.
+
+        Returns
+        -------
+        np.ndarray
+            The unnormalized probability of each of `words` (columns) in each
+            of `masked_tokens` (rows), or NaN if the word isn't in BERT's
+            vocab.
+
+        """
+        encoded = [self._encode_tokens(tokens) for tokens in masked_tokens]
+        return self._predict_words_encoded(encoded, words, fold_case)
+
+    def _predict_words_encoded(self, encoded, words, fold_case):
+        """Return the prediction of `words` for each encoded sentence."""
+        lookup = self._folded_ids if fold_case else self._ids
+        positions, vocab_ids = [], []
+        for position, word in enumerate(words):
+            ids = lookup.get(word, [])
+            positions.extend([position] * len(ids))
+            vocab_ids.extend(ids)
+        positions = torch.as_tensor(positions, dtype=torch.long)
+        vocab_ids = torch.as_tensor(vocab_ids, dtype=torch.long)
+        counts = torch.bincount(positions, minlength=len(words))
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i][0]))
+        result = np.empty((len(encoded), len(words)))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            logits = self._forward([encoded[i] for i in batch], vocab_ids)
+            sums = torch.zeros((len(batch), len(words)), dtype=logits.dtype)
+            sums.index_add_(1, positions, logits)
+            result[batch] = (sums / counts).numpy()  # 0 / 0 is NaN, as we want
+        return result
+
+    @cached_property
+    def _ids(self):
+        """dict(str : list of int): The token id of each word in the vocab."""
+        return {word: [i] for i, word in enumerate(self.vocab)}
+
+    @cached_property
+    def _folded_ids(self):
+        """dict(str : list of int): The token ids of each lowercased word."""
+        result = {}
+        for i, word in enumerate(self.vocab):
+            result.setdefault(word.lower(), []).append(i)
+        return result
+
+    def _encode(self, masked_sentence):
+        """Return the token ids of `masked_sentence` and the index of MASK."""
+        return self._encode_tokens(self.tokenize(masked_sentence))
+
+    def _encode_tokens(self, tokens):
+        """Return the token ids of the sentence `tokens` and the index of MASK."""
+        tokens = START + tokens + END
         target_index = tokens.index(MASK)
-        token_ids = self.tokens_to_ids(tokens)
-        tensor = LongTensor(token_ids).unsqueeze(0)
+        return tuple(self.tokens_to_ids(tokens)), target_index
+
+    @torch.inference_mode()
+    def _forward(self, encoded, vocab_ids=None, fold_case=False):
+        """Return the logits at the masked position of each encoded sentence.
+
+        If `vocab_ids` is given, only return the logits of those vocab entries.
+        If `fold_case`, average the logits over different casings before they
+        leave the device, so only the (smaller) folded vocab is copied back.
+
+        """
+        batch_size = len(encoded)
+        max_length = max(len(token_ids) for token_ids, _ in encoded)
+        rows = batch_size
         if self.gpu:
-            tensor = tensor.cuda()
-        probs = self.model(tensor)[0][0, target_index]
+            # pad to one of a few fixed shapes, so we can replay a CUDA graph.
+            # Rows are padded to a power of two, so small batches stay small.
+            rows = min(1 << (batch_size - 1).bit_length(), self.batch_size)
+            max_length = -(-max_length // BUCKET_SIZE) * BUCKET_SIZE
+        # views over the front of the buffers, so they stay contiguous
+        size = rows * max_length
+        input_ids = self._input_ids[:size].view(rows, max_length)
+        attention_mask = self._attention_mask[:size].view(rows, max_length)
+        target_indices = self._target_indices[:rows]
+        input_ids.fill_(self.pad_id)
+        attention_mask.zero_()
+        target_indices.zero_()
+        for i, (token_ids, target_index) in enumerate(encoded):
+            input_ids[i, : len(token_ids)] = LongTensor(token_ids)
+            attention_mask[i, : len(token_ids)] = 1
+            target_indices[i] = target_index
+        inputs = (input_ids, attention_mask, target_indices)
         if self.gpu:
-            probs = probs.cpu()
-        probs = pd.DataFrame(probs.data.numpy(), index=self.index, columns=["p"])
+            graph, static_inputs, logits = self._graph(rows, max_length)
+            for static_input, tensor in zip(static_inputs, inputs):
+                static_input.copy_(tensor, non_blocking=True)
+            graph.replay()
+        else:
+            logits = self._logits(*inputs)
+        logits = logits[:batch_size]
+        if vocab_ids is not None:
+            vocab_ids = vocab_ids.to(logits.device, non_blocking=True)
+            logits = logits.index_select(1, vocab_ids)
         if fold_case:
-            probs.index = probs.index.str.lower()
-            return probs.groupby("word").mean()
+            inverse, counts, _ = self._folding
+            folded = torch.zeros(
+                (batch_size, len(counts)), dtype=torch.float, device=logits.device
+            )
+            logits = folded.index_add_(1, inverse, logits.float()) / counts
+        probs = logits.float().to("cpu", non_blocking=self.gpu)
+        if self.gpu:
+            # wait for the copy off the GPU before anyone reads `probs`
+            torch.cuda.synchronize()
         return probs
+
+    def _masked_logits(self, input_ids, attention_mask, target_indices):
+        """Return the logits at `target_indices` of each sentence in the batch.
+
+        BertForMaskedLM applies its prediction head at every position, which
+        is a projection onto the whole vocab. We only need the masked
+        position, so we run the encoder and apply the head to that alone.
+
+        """
+        hidden = self.model.bert(input_ids, attention_mask=attention_mask)[0]
+        rows = torch.arange(hidden.shape[0], device=hidden.device)
+        return self.model.cls(hidden[rows, target_indices])
+
+    def _graph(self, rows, length):
+        """Return a CUDA graph of a forward pass on `rows` inputs of `length` tokens.
+
+        A graph is captured the first time we see each shape and replayed
+        after that, which saves launching each of BERT's kernels from Python.
+        Every graph is captured into the same memory pool. Graphs are only
+        replayed one at a time, so they can safely share activation memory.
+
+        Parameters
+        ----------
+        rows : int
+        length : int
+
+        Returns
+        -------
+        torch.cuda.CUDAGraph
+        tuple of torch.Tensor
+            The graph's input ids, attention mask and target indices. Copy
+            new inputs into these before replaying the graph.
+        torch.Tensor
+            The graph's output logits, overwritten on every replay
+
+        """
+        shape = (rows, length)
+        if shape not in self._graphs:
+            device = self.model.device
+            input_ids = torch.full(shape, self.pad_id, dtype=torch.long, device=device)
+            attention_mask = torch.ones_like(input_ids)
+            target_indices = torch.zeros(shape[0], dtype=torch.long, device=device)
+            inputs = (input_ids, attention_mask, target_indices)
+            # CUDA graphs need to be warmed up on a side stream
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(WARMUP_STEPS):
+                    self._logits(*inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=self._graph_pool):
+                logits = self._logits(*inputs)
+            self._graphs[shape] = (graph, inputs, logits)
+        return self._graphs[shape]
+
+    def _to_frame(self, probs, fold_case):
+        """Wrap the vector `probs` in a DataFrame indexed by BERT's vocab."""
+        if fold_case:  # already folded by `_forward()`
+            return pd.DataFrame(probs, index=self._folding[2], columns=["p"])
+        return pd.DataFrame(probs, index=self.index, columns=["p"])
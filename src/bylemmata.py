@@ -1,79 +1,94 @@
 """Second quick script to analyze the original method of evaluating agreement predictions."""
 
 import os
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from filenames import CLOZE_DIR, FEATURES_DIR, PROBABILITIES_DIR
+from filenames import CLOZE_DIR, FEATURES_DIR
+from utils import ProbabilityStore, probabilities_path, stored_languages
+
+CHUNKSIZE = 64  # number of cloze examples sent to a worker at a time
 
 cols = ["number", "gender", "case", "person"]
-languages = os.listdir(PROBABILITIES_DIR)
-for lg in ["hun", "gle", "fin"]:  # already done
-    languages.remove(lg)
-for lg in languages:
-    results = []
-    print(lg)
-    features_filename = os.path.join(FEATURES_DIR, f"{lg}.csv")
-    features = pd.read_csv(features_filename, dtype={"person": str})
-    cloze_filename = os.path.join(CLOZE_DIR, f"{lg}.csv")
-    cloze = pd.read_csv(cloze_filename)
-    for _, row in tqdm(cloze.iterrows()):
-        uid = row["uid"]
-        pos = row["pos"]
-        probabilities_filename = os.path.join(PROBABILITIES_DIR, lg, f"{uid}.csv")
-        try:  # we may have skipped this cloze example
-            probs = pd.read_csv(probabilities_filename)
-            lemma = row["lemma"]
-            correct_form = row["correct_form"]
-            p_correct_form = probs[probs["word"] == correct_form]["p"].max()
-            if np.isnan(
-                p_correct_form
-            ):  # the correct form didn't appear in the lexicon
-                continue
-            else:
-                is_same_pos = features["pos"] == pos
-                is_different_lemma = features["lemma"] != lemma
-                other_lemmata = features[is_same_pos & is_different_lemma]
-                if (
-                    other_lemmata.empty
-                ):  # we don't have feature data on any other lemmata
-                    continue
-                else:
-                    num_lemmata = len(other_lemmata["lemma"].unique())
-                    merged = pd.merge(
-                        probs, other_lemmata, left_on=["word"], right_on=["word"]
-                    )
-                    merged["correct"] = (merged[cols] == row[cols]).all(axis=1)
-                    incorrect_forms = merged[~merged["correct"]]
-                    lemmata = incorrect_forms["lemma"]
-                    grouped = merged[merged["lemma"].isin(lemmata)].groupby("lemma")
-                    count = 0
-                    for _, group in grouped:
-                        try:
-                            p_correct = group[group["correct"]]["p"].max()
-                            try:
-                                p_incorrect = group[~group["correct"]]["p"].max()
-                                if p_incorrect >= p_correct:
-                                    count += 1
-                            except KeyError:
-                                continue
-                        except KeyError:
-                            continue
-                    example = {
-                        "lg": lg,
-                        "uid": uid,
-                        "lemma": lemma,
-                        "correct_form": correct_form,
-                        "num_incorrect_lemmata": count,
-                        "num_lemmata": num_lemmata,
-                    }
-                    results.append(example)
-        except FileNotFoundError:
-            continue
-    results = pd.DataFrame(results)
-    results["percentage"] = 100 * (
-        results["num_incorrect_lemmata"] / results["num_lemmata"]
-    )
-    results.to_csv(f"data/bylemmata/{lg}.csv", index=False)
+
+# columns of the cloze examples that `process_row()` needs, in order
+COLUMNS = ["uid", "pos", "lemma", "correct_form"] + cols
+
+# state shared by all cloze examples of a language, set up in each worker
+lg = None
+features_by_pos = None
+probabilities = None
+
+
+def init(language, language_features_by_pos):
+    """Set up the worker process to analyze cloze examples from `language`."""
+    global lg, features_by_pos, probabilities
+    lg = language
+    features_by_pos = language_features_by_pos
+    probabilities = ProbabilityStore(probabilities_path(language))
+
+
+def process_row(row):
+    """Return the analysis of the cloze example `row`, or None to skip it."""
+    uid, pos, lemma, correct_form, *values = row
+    if uid not in probabilities:  # we may have skipped this cloze example
+        return None
+    probs = probabilities[uid]
+    probs = dict(zip(probs["word"].to_numpy(), probs["p"].to_numpy()))
+    p_correct_form = probs.get(correct_form, np.nan)
+    if np.isnan(p_correct_form):  # the correct form didn't appear in the lexicon
+        return None
+    else:
+        if pos not in features_by_pos:  # we don't have feature data on this POS
+            return None
+        same_pos = features_by_pos[pos]
+        other_lemmata = same_pos[same_pos["lemma"] != lemma]
+        if other_lemmata.empty:  # we don't have feature data on any other lemmata
+            return None
+        else:
+            num_lemmata = len(other_lemmata["lemma"].unique())
+            merged = other_lemmata.assign(p=other_lemmata["word"].map(probs))
+            merged = merged.dropna(subset=["p"])
+            merged["correct"] = (merged[cols] == values).all(axis=1)
+            # a lemma counts as incorrect if BERT prefers one of its
+            # incorrect forms to all of its correct ones
+            maxima = merged.groupby(["lemma", "correct"], observed=True)["p"].max()
+            maxima = maxima.unstack("correct").reindex(columns=[False, True])
+            count = int((maxima[False] >= maxima[True]).sum())
+            return {
+                "lg": lg,
+                "uid": uid,
+                "lemma": lemma,
+                "correct_form": correct_form,
+                "num_incorrect_lemmata": count,
+                "num_lemmata": num_lemmata,
+            }
+
+
+if __name__ == "__main__":
+    languages = stored_languages()
+    for language in ["hun", "gle", "fin"]:  # already done
+        languages.remove(language)
+    for language in languages:
+        print(language)
+        features_filename = os.path.join(FEATURES_DIR, f"{language}.parquet")
+        features = pd.read_parquet(features_filename)
+        # comparing categoricals compares integer codes rather than strings
+        features[["lemma"] + cols] = features[["lemma"] + cols].astype("category")
+        # split once here rather than filtering on POS for every example
+        language_features_by_pos = dict(iter(features.groupby("pos", observed=True)))
+        cloze_filename = os.path.join(CLOZE_DIR, f"{language}.parquet")
+        cloze = pd.read_parquet(cloze_filename)
+        rows = cloze[COLUMNS].itertuples(index=False, name=None)
+        initargs = (language, language_features_by_pos)
+        with Pool(initializer=init, initargs=initargs) as pool:
+            examples = pool.imap(process_row, rows, chunksize=CHUNKSIZE)
+            results = [e for e in tqdm(examples, total=len(cloze)) if e]
+        results = pd.DataFrame(results)
+        results["percentage"] = 100 * (
+            results["num_incorrect_lemmata"] / results["num_lemmata"]
+        )
+        results.to_csv(f"data/bylemmata/{language}.csv", index=False)
@@ -1,67 +1,89 @@
 """Quick script to analyze the original method of evaluating agreement predictions."""
 import os
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from filenames import CLOZE_DIR, FEATURES_DIR, PROBABILITIES_DIR
+from filenames import CLOZE_DIR, FEATURES_DIR
+from utils import ProbabilityStore, probabilities_path, stored_languages
 
-results = []
-for lg in os.listdir(PROBABILITIES_DIR):
-    print(lg)
-    features_filename = os.path.join(FEATURES_DIR, f"{lg}.csv")
-    features = pd.read_csv(features_filename)
-    cloze_filename = os.path.join(CLOZE_DIR, f"{lg}.csv")
-    cloze = pd.read_csv(cloze_filename)
-    for _, row in tqdm(cloze.iterrows()):
-        uid = row["uid"]
-        pos = row["pos"]
-        probabilities_filename = os.path.join(PROBABILITIES_DIR, lg, f"{uid}.csv")
-        try:  # we may have skipped this cloze example
-            probs = pd.read_csv(probabilities_filename)
-            lemma = row["lemma"]
-            correct_form = row["correct_form"]
-            p_correct_form = probs[probs["word"] == correct_form]["p"].max()
+CHUNKSIZE = 64  # number of cloze examples sent to a worker at a time
+
+# columns of the cloze examples that `process_row()` needs, in order
+COLUMNS = ["uid", "pos", "lemma", "correct_form"]
+
+# state shared by all cloze examples of a language, set up in each worker
+lg = None
+forms = None
+probabilities = None
+
+
+def init(language, language_forms):
+    """Set up the worker process to analyze cloze examples from `language`."""
+    global lg, forms, probabilities
+    lg = language
+    forms = language_forms
+    probabilities = ProbabilityStore(probabilities_path(language))
+
+
+def process_row(row):
+    """Return the analysis of the cloze example `row`, or None to skip it."""
+    uid, pos, lemma, correct_form = row
+    if uid not in probabilities:  # we may have skipped this cloze example
+        return None
+    probs = probabilities[uid].set_index("word")["p"]
+    p_correct_form = probs.get(correct_form, np.nan)
+    if np.isnan(p_correct_form):  # the correct form didn't appear in the lexicon
+        return None
+    else:
+        incorrect_forms = [
+            form for form in forms.get((lemma, pos), []) if form != correct_form
+        ]
+        if not incorrect_forms:
+            # we don't have feature data on any incorrect forms
+            return None
+        else:
+            p_incorrect_forms = probs.reindex(incorrect_forms).to_numpy()
             if np.isnan(
-                p_correct_form
-            ):  # the correct form didn't appear in the lexicon
-                continue
+                p_incorrect_forms
+            ).all():  # no incorrect forms appear in the lexicon
+                return None
             else:
-                is_same_lemma = features["lemma"] == lemma
-                is_same_pos = features["pos"] == pos
-                is_incorrect_form = features["word"] != correct_form
-                incorrect_forms = features[
-                    is_same_lemma & is_same_pos & is_incorrect_form
-                ]["word"]
-                if (
-                    incorrect_forms.empty
-                ):  # we don't have feature data on any incorrect forms
-                    continue
-                else:
-                    probs_incorrect_forms = probs[probs["word"].isin(incorrect_forms)]
-                    p_incorrect_form = probs_incorrect_forms["p"].max()
-                    if np.isnan(
-                        p_incorrect_form
-                    ):  # no incorrect forms appear in the lexicon
-                        continue
-                    else:
-                        incorrect_form = probs_incorrect_forms[
-                            probs_incorrect_forms["p"] == p_incorrect_form
-                        ]["word"].iloc[0]
-                        example = {
-                            "lg": lg,
-                            "uid": uid,
-                            "lemma": lemma,
-                            "correct_form": correct_form,
-                            "p_correct_form": p_correct_form,
-                            "incorrect_form": incorrect_form,
-                            "p_incorrect_form": p_incorrect_form,
-                        }
-                        results.append(example)
-        except FileNotFoundError:
-            continue
-results = pd.DataFrame(results)
-results["right"] = results["p_correct_form"] > results["p_incorrect_form"]
-results["margin"] = results["p_correct_form"] - results["p_incorrect_form"]
-results.to_csv("data/bymargin.csv", index=False)
+                i = np.nanargmax(p_incorrect_forms)
+                p_incorrect_form = p_incorrect_forms[i]
+                incorrect_form = incorrect_forms[i]
+                return {
+                    "lg": lg,
+                    "uid": uid,
+                    "lemma": lemma,
+                    "correct_form": correct_form,
+                    "p_correct_form": p_correct_form,
+                    "incorrect_form": incorrect_form,
+                    "p_incorrect_form": p_incorrect_form,
+                }
+
+
+if __name__ == "__main__":
+    results = []
+    for language in stored_languages():
+        print(language)
+        features_filename = os.path.join(FEATURES_DIR, f"{language}.parquet")
+        features = pd.read_parquet(features_filename)
+        cloze_filename = os.path.join(CLOZE_DIR, f"{language}.parquet")
+        cloze = pd.read_parquet(cloze_filename)
+        # all the forms of each lemma, so we don't have to scan `features` per row
+        lemma_forms = (
+            features.groupby(["lemma", "pos"], observed=True)["word"]
+            .apply(list)
+            .to_dict()
+        )
+        rows = cloze[COLUMNS].itertuples(index=False, name=None)
+        with Pool(initializer=init, initargs=(language, lemma_forms)) as pool:
+            examples = pool.imap(process_row, rows, chunksize=CHUNKSIZE)
+            results.extend(e for e in tqdm(examples, total=len(cloze)) if e)
+    results = pd.DataFrame(results)
+    results["right"] = results["p_correct_form"] > results["p_incorrect_form"]
+    results["margin"] = results["p_correct_form"] - results["p_incorrect_form"]
+    results.to_csv("data/bymargin.csv", index=False)
@@ -1,68 +1,86 @@
 """Third quick script to analyze the original method of evaluating agreement predictions."""
 
 import os
+from multiprocessing import Pool
 
 import fire
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from filenames import CLOZE_DIR, FEATURES_DIR, PROBABILITIES_DIR
+from filenames import CLOZE_DIR, FEATURES_DIR
+from utils import ProbabilityStore, probabilities_path
+
+CHUNKSIZE = 64  # number of cloze examples sent to a worker at a time
 
 cols = ["number", "gender", "case", "person"]
 
-def run(lg):
-    results = []
-    features_filename = os.path.join(FEATURES_DIR, f"{lg}.csv")
-    features = pd.read_csv(features_filename, dtype={"person": str})
-    cloze_filename = os.path.join(CLOZE_DIR, f"{lg}.csv")
-    cloze = pd.read_csv(cloze_filename)
-    for _, row in tqdm(cloze.iterrows()):
-        uid = row["uid"]
-        probabilities_filename = os.path.join(PROBABILITIES_DIR, lg, f"{uid}.csv")
-        try:  # we may have skipped this cloze example
-            probs = pd.read_csv(probabilities_filename)
-            pos = row["pos"]
-            lemma = row["lemma"]
-            correct_form = row["correct_form"]
-            p_correct_form = probs[probs["word"] == correct_form]["p"].max()
+# columns of the cloze examples that `process_row()` needs, in order
+COLUMNS = ["uid", "pos", "lemma", "correct_form", "masked"]
+
+# state shared by all cloze examples of a language, set up in each worker
+lg = None
+features = None
+probabilities = None
+
+
+def init(language, language_features):
+    """Set up the worker process to analyze cloze examples from `language`."""
+    global lg, features, probabilities
+    lg = language
+    features = language_features
+    probabilities = ProbabilityStore(probabilities_path(language))
+
+
+def process_row(row):
+    """Return the analysis of the cloze example `row`, or None to skip it."""
+    uid, pos, lemma, correct_form, masked = row
+    if uid not in probabilities:  # we may have skipped this cloze example
+        return None
+    probs = probabilities[uid].set_index("word")["p"]
+    p_correct_form = probs.get(correct_form, np.nan)
+    if np.isnan(p_correct_form):  # the correct form didn't appear in the lexicon
+        return None
+    else:
+        is_same_lemma = features["lemma"] == lemma
+        is_same_pos = features["pos"] == pos
+        is_incorrect_form = features["word"] != correct_form
+        is_incorrect = is_same_lemma & is_same_pos & is_incorrect_form
+        incorrect_forms = features[is_incorrect]["word"]
+        if (
+            incorrect_forms.empty
+        ):  # we don't have feature data on any incorrect forms
+            return None
+        else:
+            p_incorrect_form = probs.reindex(incorrect_forms).max()
             if np.isnan(
-                p_correct_form
-            ):  # the correct form didn't appear in the lexicon
-                continue
+                p_incorrect_form
+            ):  # no incorrect forms appear in the lexicon
+                return None
             else:
-                is_same_lemma = features["lemma"] == lemma
-                is_same_pos = features["pos"] == pos
-                is_incorrect_form = features["word"] != correct_form
-                incorrect_forms = features[
-                    is_same_lemma & is_same_pos & is_incorrect_form
-                ]["word"]
-                if (
-                    incorrect_forms.empty
-                ):  # we don't have feature data on any incorrect forms
-                    continue
-                else:
-                    probs_incorrect_forms = probs[probs["word"].isin(incorrect_forms)]
-                    p_incorrect_form = probs_incorrect_forms["p"].max()
-                    if np.isnan(
-                        p_incorrect_form
-                    ):  # no incorrect forms appear in the lexicon
-                        continue
-                    else:
-                        old_right = p_correct_form > p_incorrect_form
-                        example = {
-                            "lg": lg,
-                            "uid": uid,
-                            "masked": row["masked"],
-                            "old_right": old_right
-                        }
-                        results.append(example)
-        except FileNotFoundError:
-            continue
+                old_right = p_correct_form > p_incorrect_form
+                return {
+                    "lg": lg,
+                    "uid": uid,
+                    "masked": masked,
+                    "old_right": old_right,
+                }
+
+
+def run(lg):
+    features_filename = os.path.join(FEATURES_DIR, f"{lg}.parquet")
+    features = pd.read_parquet(features_filename)
+    # comparing categoricals compares integer codes rather than strings
+    features = features.astype("category")
+    cloze_filename = os.path.join(CLOZE_DIR, f"{lg}.parquet")
+    cloze = pd.read_parquet(cloze_filename)
+    rows = cloze[COLUMNS].itertuples(index=False, name=None)
+    with Pool(initializer=init, initargs=(lg, features)) as pool:
+        examples = pool.imap(process_row, rows, chunksize=CHUNKSIZE)
+        results = [e for e in tqdm(examples, total=len(cloze)) if e]
     results = pd.DataFrame(results)
     results.to_csv(f"data/previous/{lg}.csv", index=False)
 
 
 if __name__ == "__main__":
     fire.Fire(run)
-
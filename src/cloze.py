@@ -9,20 +9,235 @@ This module is intended to be run as a script:
 
 """
 import os
+import pickle
+import sys
+from collections import namedtuple
 from glob import glob
-from operator import xor
+from multiprocessing import Pool
 
 import pandas as pd
-import pyconll
+import zstandard as zstd
+from conllu import parse_incr
 
-from constants import AGREEMENT_TYPES, DISAGREE, LANGUAGES, MASK, MISSING, NA
+from constants import AGREEMENT_TYPES, LANGUAGES, MASK, NA
 from features import feature_value
 from filenames import CLOZE_DIR, UNIVERSAL_DEPENDENCIES_DIR
 from utils import refresh
 
+EMPTY = "_"  # how CoNLL-U marks an empty field
+CACHE_SUFFIX = ".tokens.pkl.zst"  # appended to a CoNLL-U file's parse cache
+CACHE_VERSION = 2  # format of the parse cache, see `parse_conllu()`
+FEATURES = ["number", "gender", "case", "person"]
+
+# columns of the cloze examples, in order
+COLUMNS = [
+    "uid",
+    "lemma",
+    "type",
+    "pos",
+    "number",
+    "gender",
+    "case",
+    "person",
+    "masked",
+    "other_masked",
+    "other_lemma",
+    "intervening_noun",
+    "num_distractors",
+    "correct_form",
+    "other_correct_form",
+]
+
+# the fields of a CoNLL-U token that we use. As in pyconll, ids and heads are
+# strings (e.g. "3", "3-4" or "3.1"), empty fields are None and the values of
+# each feature are a set. `values` holds the token's value of each of FEATURES.
+Token = namedtuple(
+    "Token", ["id", "form", "lemma", "upos", "deprel", "head", "feats", "values"]
+)
+
+# `index` maps the id of each token to its position in `tokens` and `nouns`
+# are the nouns among them. `subjects` maps the id of a token to its (first)
+# subject. `words` and `positions` are as returned by `surface_words()`.
+# `masked` and `distractors` remember the results of `mask()` and
+# `count_distractors()` for each token id as they are needed.
+Sentence = namedtuple(
+    "Sentence",
+    [
+        "id",
+        "tokens",
+        "index",
+        "nouns",
+        "subjects",
+        "words",
+        "positions",
+        "masked",
+        "distractors",
+    ],
+)
 
-def mask(sentence, mask_id):
-    """Mask the token at `mask_id` in `sentence`.
+
+def none_if_empty(value):
+    """Return None if `value` is an empty CoNLL-U field, else `value`."""
+    return None if value == EMPTY else value
+
+
+def intern_if_not_empty(value):
+    """Return None if `value` is an empty CoNLL-U field, else `value` interned.
+
+    POS tags and dependency relations come from a small set of strings that we
+    compare over and over, so we intern them to make those comparisons cheap.
+
+    """
+    return None if value == EMPTY else sys.intern(value)
+
+
+def raw_fields(token):
+    """Return the fields of a token parsed by conllu that we use, as a tuple.
+
+    These are as they appear in the CoNLL-U file, apart from ids and heads,
+    which are converted to strings, and features, which are kept as a tuple of
+    (feature, values) pairs. They only hold built-in types, so they can be
+    pickled independently of this module.
+
+    Parameters
+    ----------
+    token : conllu Token
+
+    Returns
+    -------
+    tuple
+
+    """
+    id_ = token["id"]
+    if isinstance(id_, tuple):  # a multiword token or an empty node
+        id_ = "".join(str(part) for part in id_)
+    else:
+        id_ = str(id_)
+    head = token["head"]
+    feats = tuple((token["feats"] or {}).items())
+    return (
+        id_,
+        token["form"],
+        token["lemma"],
+        token["upos"],
+        token["deprel"],
+        None if head is None else str(head),
+        feats,
+    )
+
+
+def to_token(fields):
+    """Convert the fields returned by `raw_fields()` into a `Token`.
+
+    Parameters
+    ----------
+    fields : tuple
+
+    Returns
+    -------
+    Token
+
+    """
+    id_, form, lemma, upos, deprel, head, feats = fields
+    # if both are empty then the word really is an underscore
+    if (form != EMPTY) or (lemma != EMPTY):
+        form, lemma = none_if_empty(form), none_if_empty(lemma)
+    token = Token(
+        id_,
+        form,
+        lemma,
+        intern_if_not_empty(upos),
+        intern_if_not_empty(deprel),
+        head,
+        {feature: set(value.split(",")) for feature, value in feats},
+        None,
+    )
+    # look the feature values up once here, rather than every time we compare
+    # this token with another one
+    values = tuple(feature_value(token.feats, feature) for feature in FEATURES)
+    return token._replace(values=values)
+
+
+def load_cache(cache):
+    """Return the sentences saved in `cache`, or None if it's out of date."""
+    errors = (OSError, EOFError, pickle.UnpicklingError, zstd.ZstdError)
+    try:
+        with open(cache, "rb") as file:
+            version, result = pickle.loads(zstd.decompress(file.read()))
+    except errors + (ValueError, TypeError):  # e.g. a cache in an old format
+        return None
+    return result if version == CACHE_VERSION else None
+
+
+def save_cache(cache, result):
+    """Save the sentences `result` to `cache`.
+
+    We write to a temporary file and move it into place, so an interrupted
+    run can't leave a truncated cache behind.
+
+    """
+    temporary = f"{cache}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(zstd.compress(pickle.dumps((CACHE_VERSION, result), protocol=5)))
+    os.replace(temporary, cache)
+
+
+def parse_conllu(fname):
+    """Return the id and `Token`s of each sentence in the CoNLL-U file `fname`.
+
+    The UD corpora don't change between runs, but parsing them is the slowest
+    part of preparing cloze examples. So we save the fields we parse alongside
+    each file, compressed, and read those instead until the file changes.
+    We only save the raw fields (see `raw_fields()`), so that changes to how
+    we derive feature values take effect without clearing the cache. Bump
+    CACHE_VERSION whenever `raw_fields()` changes.
+
+    Parameters
+    ----------
+    fname : str
+
+    Returns
+    -------
+    list of (str, list of Token)
+
+    """
+    cache = fname + CACHE_SUFFIX
+    result = None
+    if os.path.exists(cache) and (os.path.getmtime(cache) >= os.path.getmtime(fname)):
+        result = load_cache(cache)
+    if result is None:
+        with open(fname, encoding="utf-8") as file:
+            result = [
+                (
+                    tokenlist.metadata.get("sent_id"),
+                    [raw_fields(token) for token in tokenlist],
+                )
+                for tokenlist in parse_incr(file)
+            ]
+        save_cache(cache, result)
+    return [
+        (sent_id, [to_token(fields) for fields in tokens])
+        for sent_id, tokens in result
+    ]
+
+
+def read_conllu(fname):
+    """Yield each sentence in the CoNLL-U file `fname` as a `Sentence`."""
+    for sent_id, tokens in parse_conllu(fname):
+        index = {token.id: i for i, token in enumerate(tokens)}
+        nouns = [token for token in tokens if token.upos == "NOUN"]
+        subjects = {}
+        for token in tokens:
+            if is_subject(token):
+                subjects.setdefault(token.head, token)
+        words, positions = surface_words(tokens)
+        yield Sentence(
+            sent_id, tokens, index, nouns, subjects, words, positions, {}, {}
+        )
+
+
+def surface_words(tokens):
+    """Return the words of a sentence as they appear, and where each token is.
 
     This is complicated by multiword tokens in the Universal Dependencies
     schema. If the form to be masked out is actually part of a multiword token,
@@ -32,236 +247,212 @@ def mask(sentence, mask_id):
     lack of spaces after certain tokens (i.e. the SpaceAfter field in the
     schema) because BERT's tokenizer splits off punctuation anyway.
 
+    We work this out once per sentence so that masking a token is just a
+    matter of swapping MASK in for its word(s).
+
     Parameters
     ----------
-    sentence : pyconll Sentence
-    mask_id : pyconll id
+    tokens : list of Token
 
     Returns
     -------
-    str
+    list of str
+        The words of the sentence
+    dict(str : list of int)
+        Position(s) in the words of each token id. The component words of a
+        multiword token are at the position of the multiword token.
 
     """
-    result = []
-    ids_to_skip = []  # ids of the component words of multiword tokens
-    for token in sentence:
-        if token.form and token.form != "_":
-            if not token.is_multiword():
+    words = []
+    positions = {}
+    ids_to_skip = set()  # ids of the component words of multiword tokens
+    for token in tokens:
+        if token.form and token.form != EMPTY:
+            if "-" not in token.id:
                 if token.id not in ids_to_skip:
-                    if token.id == mask_id:
-                        result.append(MASK)
-                    else:
-                        result.append(token.form)
+                    positions.setdefault(token.id, []).append(len(words))
+                    words.append(token.form)
                 else:  # the word is actually part of a multiword token
                     continue
             else:  # the token is a multiword token
                 start, end = token.id.split("-")
                 # ids of all the componenet words in the multiword token
                 ids = [str(i) for i in range(int(start), int(end) + 1)]
-                if mask_id in ids:
-                    result.append(MASK)
-                else:
-                    result.append(token.form)
-                ids_to_skip.extend(ids)  # make sure to skip component words
+                for id_ in ids:
+                    positions.setdefault(id_, []).append(len(words))
+                words.append(token.form)
+                ids_to_skip.update(ids)  # make sure to skip component words
         else:  # there's no form to add
             continue
-    return " ".join(result)
+    return words, positions
 
 
-def agreement_value(token1, token2, feature):
-    """Return the agreement value of `token1` and `token2` in `feature`.
-
-    I'm using the term agreement value to mean a couple of different things.
-    First, it could be a feature value (e.g. singular or first person). The
-    agreement value will be a feature value like this if the two tokens have
-    the same feature value for that feature. For example, the English words
-    "these" and "dogs" will have an agreement value of plural for number
-    because they are both plural. Second, it could be the fact that one of the
-    tokens is missing a feature value. In this case, we return MISSING. An
-    example of this would be English "he" and "tall" for gender, in which only
-    "he" is marked for gender. Finally, it could be the fact that the two
-    tokens disagree in that feature. This could be an incorrectly annotated
-    token. See the comments in constants.py for more discussion.
-
-    We end up removing any cloze examples where one of the values is DISAGREE.
+def mask(sentence, mask_id):
+    """Mask the token at `mask_id` in `sentence`.
 
     Parameters
     ----------
-    token1, token2 : pyconll Token
-    feature : str
+    sentence : Sentence
+    mask_id : str
 
     Returns
     -------
     str
-        Either a feature value or MISSING or DISAGREE
 
     """
-    value1 = feature_value(token1, feature)
-    value2 = feature_value(token2, feature)
-    # the two values will be equal if they are geniunely the same feature value
-    # (e.g. both "Sing") or if they are both NA.
-    if value1 == value2:
-        return value1
-    value1_is_missing = value1 == NA  # don't rely on NA being falsey
-    value2_is_missing = value2 == NA
-    if xor(value1_is_missing, value2_is_missing):
-        return MISSING
-    return DISAGREE
+    words = list(sentence.words)
+    for position in sentence.positions.get(mask_id, []):
+        words[position] = MASK
+    return " ".join(words)
 
 
 def intervening_noun(sentence, target, controller):
     """Return True if a noun intervenes between `target` and `controller`."""
-    slice = sentence[target.id : controller.id][1:]
+    start, end = sentence.index[target.id], sentence.index[controller.id]
+    slice = sentence.tokens[start:end][1:]
     for token in slice:
         if token.upos == "NOUN":
             return True
     return False
 
 
+def disagrees(value1, value2):
+    """Return True if the feature values `value1` and `value2` disagree.
+
+    Two values disagree if they are both genuine feature values (i.e. not NA)
+    and different. For example, the English words "this" and "dogs" disagree
+    in number. A token missing a value, like "tall" for gender, doesn't
+    disagree with anything. Disagreement could also be an incorrectly
+    annotated token. See the comments in constants.py for more discussion.
+
+    """
+    return (value1 != value2) and (value1 != NA) and (value2 != NA)
+
+
 def agree(token1, token2):
     """Return True if `token1` and `token2` agree."""
-    for feature in ["number", "gender", "case", "person"]:
-        value = agreement_value(token1, token2, feature)
-        if value == DISAGREE:
+    for value1, value2 in zip(token1.values, token2.values):
+        if disagrees(value1, value2):
             return False
     return True
 
 
 def count_distractors(sentence, token):
     """Return the number of nouns in `sentence` that don't match `token`."""
-    nouns = [t for t in sentence if t.upos == "NOUN"]
-    return sum([agree(noun, token) for noun in nouns])
+    # the same token is often part of several agreement relations
+    if token.id not in sentence.distractors:
+        count = sum([agree(noun, token) for noun in sentence.nouns])
+        sentence.distractors[token.id] = count
+    return sentence.distractors[token.id]
+
 
+def extract(sentence, target, controller, type_, result):
+    """Extract relevant information for the cloze examples of a relation.
 
-def extract(sentence, target, controller, type_, reverse=False):
-    """Extract relevant information for the cloze example.
+    We make two cloze examples from each agreement relation: one with the
+    controller masked out and one with the target masked out. Most of the
+    information is shared between the two, so we work it out once for both.
 
     Parameters
     ----------
-    sentence : pyconll Sentence
-    target, controller : pyconll Token
+    sentence : Sentence
+    target, controller : Token
     type_ : str
         Type of agreement relation
-    reverse : bool
-        We normally mask out the controller, but setting this to True masks out the target
-
-    Returns
-    -------
-    dict
+    result : dict(str : list)
+        Columns of cloze examples. The example with the controller masked out
+        is appended to them, then the one with the target masked out.
 
     """
-    example = {"type": type_, "uid": sentence.id}
-    if reverse:
-        word_to_mask = target
-        other_word = controller
-    else:
-        word_to_mask = controller
-        other_word = target
-    example["masked"] = mask(sentence, word_to_mask.id)
-    example["pos"] = word_to_mask.upos
-    example["lemma"] = word_to_mask.lemma
-    example["correct_form"] = word_to_mask.form
     # we want to cloze examples that involve agreement between two tokens,
     # but we also want to allow for missing feature values on the tokens
     # when a language doesn't mark that feature on that token (e.g. English
     # subjects don't mark person). So we note the feature values of the masked
-    # word and also note if there's any disagreement between the two tokens.
-    # If there is, we'll filter them out.
-    example["agree"] = agree(target, controller)
-    for feature in ["number", "gender", "case", "person"]:
-        example[feature] = feature_value(word_to_mask, feature)
-    # the data below is used to understand the lingiustic contexts in which
-    # performance is affected. we use `other_masked` to calcuate the linear
-    # distance between the two words in experiment.py. We may want to only look
-    # at distance if there's no intervening noun, as in Linzen et al. (2016).
-    # We also count the number of "incorrect" nouns in the sentence.
-    example["other_masked"] = mask(sentence, other_word.id)
-    example["other_lemma"] = other_word.lemma
-    example["other_correct_form"] = other_word.form
-    example["intervening_noun"] = intervening_noun(sentence, target, controller)
-    example["num_distractors"] = count_distractors(sentence, word_to_mask)
-    return example
-
-
-def is_determiner_relation(token1, token2):
-    """Return True if `token1` is the determiner of `token2`."""
-    return (
-        (token1.upos == "DET")
-        and (token1.deprel in ["det", "det:predet"])
-        and (token2.upos == "NOUN")
-        and (token1.head == token2.id)
-    )
-
-
-def is_modifying_adjective_relation(token1, token2):
-    """Return True if `token1` is an adjective modifying noun `token2`."""
-    return (
-        (token1.upos == "ADJ")
-        and (token1.deprel == "amod")
-        and (token2.upos == "NOUN")
-        and (token1.head == token2.id)
-    )
-
-
-def is_predicated_adjective_relation(token1, token2):
-    """Return True if `token1` is an adjective predicated of `token2`."""
-    return (
-        (token1.upos == "ADJ")
-        and (token2.upos in ["NOUN", "PRON"])
-        and (token2.deprel == "nsubj")
-        and (token2.head == token1.id)
-    )
-
-
-def is_verb_relation(token1, token2):
-    """Return True if `token1` is a verb with subject `token2`."""
-    return (
-        (token1.upos == "VERB")
-        and (token2.upos in ["NOUN", "PRON"])
-        and (token2.deprel == "nsubj")
-        and (token2.head == token1.id)
-    )
-
+    # word, and leave out relations where the two tokens disagree and masked
+    # words without values for all four features.
+    if not agree(target, controller):
+        return
+    for token in [target, controller]:
+        if token.id not in sentence.masked:
+            sentence.masked[token.id] = mask(sentence, token.id)
+    has_intervening_noun = intervening_noun(sentence, target, controller)
+    for word_to_mask, other_word in [(controller, target), (target, controller)]:
+        if all(value == NA for value in word_to_mask.values):
+            continue
+        result["type"].append(type_)
+        result["uid"].append(sentence.id)
+        result["masked"].append(sentence.masked[word_to_mask.id])
+        result["pos"].append(word_to_mask.upos)
+        result["lemma"].append(word_to_mask.lemma)
+        result["correct_form"].append(word_to_mask.form)
+        for feature, value in zip(FEATURES, word_to_mask.values):
+            result[feature].append(value)
+        # the data below is used to understand the lingiustic contexts in which
+        # performance is affected. we use `other_masked` to calcuate the linear
+        # distance between the two words in experiment.py. We may want to only
+        # look at distance if there's no intervening noun, as in Linzen et al.
+        # (2016). We also count the number of "incorrect" nouns in the sentence.
+        result["other_masked"].append(sentence.masked[other_word.id])
+        result["other_lemma"].append(other_word.lemma)
+        result["other_correct_form"].append(other_word.form)
+        result["intervening_noun"].append(has_intervening_noun)
+        num_distractors = count_distractors(sentence, word_to_mask)
+        result["num_distractors"].append(num_distractors)
+
+
+# the relations we look for between a token and its head, keyed by the POS
+# of the token, its dependency relation to its head and the POS of the head:
+#
+#     * determiner: a determiner of a noun
+#     * modifying: an adjective modifying a noun
+#     * predicated: the subject of a predicated adjective
+#     * verb: the subject of a verb
+#     * auxiliary: an auxiliary dependent of a verb
+#
+# Copulas are the exception (see `classify()`).
+RELATIONS = {
+    ("DET", "det", "NOUN"): "determiner",
+    ("DET", "det:predet", "NOUN"): "determiner",
+    ("ADJ", "amod", "NOUN"): "modifying",
+    ("NOUN", "nsubj", "ADJ"): "predicated",
+    ("PRON", "nsubj", "ADJ"): "predicated",
+    ("NOUN", "nsubj", "VERB"): "verb",
+    ("PRON", "nsubj", "VERB"): "verb",
+    ("AUX", "aux", "VERB"): "auxiliary",
+    ("AUX", "aux:pass", "VERB"): "auxiliary",
+}
+
+
+def classify(token, head):
+    """Return the kind of relation between `token` and its `head`.
 
-def is_copula_relation(token1, token2):
-    """Return True if `token1` is a copula dependent of `token2`.
+    Parameters
+    ----------
+    token, head : Token
 
-    We don't want to capture cases where `token2` is an adjective, because
-    we capture those in `is_predicated_adjective_relation()`.
+    Returns
+    -------
+    str or None
+        One of the values of RELATIONS, or "copula" if `token` is a copula
+        dependent of `head`, or None if it's none of these. We don't want to
+        capture copulas where `head` is an adjective, because we capture
+        those as predicated adjectives.
 
     """
-    return (
-        (token1.deprel == "cop")
-        and (token2.upos != "ADJ")
-        and (token1.head == token2.id)
-    )
+    upos, deprel, head_upos = token.upos, token.deprel, head.upos
+    if (deprel == "cop") and (head_upos != "ADJ"):
+        return "copula"
+    return RELATIONS.get((upos, deprel, head_upos))
 
 
-def is_auxiliary_relation(token1, token2):
-    """Return True if `token1` is an auxiliary dependent of `token2`."""
-    return (
-        (token1.upos == "AUX")
-        and (token1.deprel in ["aux", "aux:pass"])
-        and (token2.upos == "VERB")
-        and (token1.head == token2.id)
-    )
-
-
-def is_subject(token1, token2):
-    """Return True if `token1` is the subject of `token2`."""
-    return (
-        (token1.upos in ["NOUN", "PRON"])
-        and (token1.deprel == "nsubj")
-        and (token1.head == token2.id)
-    )
+def is_subject(token):
+    """Return True if `token` is the subject of its head."""
+    return (token.upos in ["NOUN", "PRON"]) and (token.deprel == "nsubj")
 
 
 def find_subject(token, sentence):
-    """Return the subject of `token` in sentence."""
-    for potential_subject in sentence:
-        if is_subject(potential_subject, token):
-            return potential_subject
-    return None
+    """Return the subject of `token` in sentence, or None if it has none."""
+    return sentence.subjects.get(token.id)
 
 
 def collect_agreement_relations(fname):
@@ -288,9 +479,9 @@ def collect_agreement_relations(fname):
     looking for instances of the four types listed above (e.g. we look for a
     determiner and its head noun, a predicated adjective and its subject).
     Each instance we find is a potential agreement relation. For every instance
-    we find, we extract the agreement values of the two tokens (see the
-    agreement_value function for exactly what I mean by this). Provided the
-    instance has at least one genuine agreement value then we will keep it.
+    we find, we compare the feature values of the two tokens (see the
+    `disagrees` function for exactly what I mean by this). Provided the two
+    tokens don't disagree in any feature then we will keep it.
 
     Parameters
     ----------
@@ -303,95 +494,45 @@ def collect_agreement_relations(fname):
         agreement values for the four features, and the masked sentence
 
     """
-    conll = pyconll.iter_from_file(fname)
-    result = []
-    for sentence in conll:
-        for token in sentence:
-            try:
-                head = sentence[token.head]
-            except (KeyError, ValueError):
+    # built up column by column, rather than as one dict per example
+    result = {column: [] for column in COLUMNS}
+    for sentence in read_conllu(fname):
+        for token in sentence.tokens:
+            position = sentence.index.get(token.head)
+            if position is None:
                 # problem with the underlying file or annotation
                 continue
-            if is_determiner_relation(token, head):
-                instance = extract(sentence, token, head, "determiner")
-                result.append(instance)
-                instance = extract(
-                    sentence, token, head, "determiner", reverse=True
-                )  # quick fix to get examples with both maskings
-                result.append(instance)
-            elif is_modifying_adjective_relation(token, head):
-                instance = extract(sentence, token, head, "modifying")
-                result.append(instance)
-                instance = extract(sentence, token, head, "modifying", reverse=True)
-                result.append(instance)
+            head = sentence.tokens[position]
+            kind = classify(token, head)
+            if kind in ["determiner", "modifying"]:
+                extract(sentence, token, head, kind, result)
             # The Universal Dependency schema annotates a predicated adjective
             # or a verb as the head of a nominal. However, syntactically the
             # adjective/verb is the target of agreement with the nominal. To
-            # account for this, if we find one of the next two functions, we
-            # pass in `head` as the `token1` and `token` as `token2`.
-            elif is_predicated_adjective_relation(head, token):
-                instance = extract(sentence, head, token, "predicated")
-                result.append(instance)
-                instance = extract(sentence, head, token, "predicated", reverse=True)
-                result.append(instance)
-            elif is_verb_relation(head, token):
-                instance = extract(sentence, head, token, "verb")
-                result.append(instance)
-                instance = extract(sentence, head, token, "verb", reverse=True)
-                result.append(instance)
+            # account for this, in these two cases we pass in `head` as the
+            # target and `token` as the controller.
+            elif kind in ["predicated", "verb"]:
+                extract(sentence, head, token, kind, result)
             # The Universal Dependencies schema annotates copulas as dependents
             # of the predicate, and auxiliaries as dependents of the main verb.
             # However, we want to extract the subjects in these cases, so once
             # we find a copula or auxiliary, we have to go looking for the
             # subject too. The subject is the controller of the agreement,
             # while the copula/auxiliary is the target.
-            elif is_copula_relation(token, head):
+            elif kind in ["copula", "auxiliary"]:
                 subject = find_subject(token, sentence)
                 if subject:  # maybe we didn't find a subject
-                    instance = extract(sentence, token, subject, "verb")
-                    result.append(instance)
-                    instance = extract(sentence, token, subject, "verb", reverse=True)
-                    result.append(instance)
-            elif is_auxiliary_relation(token, head):
-                subject = find_subject(token, sentence)
-                if subject:
-                    instance = extract(sentence, token, subject, "verb")
-                    result.append(instance)
-                    instance = extract(sentence, token, subject, "verb", reverse=True)
-                    result.append(instance)
+                    extract(sentence, token, subject, "verb", result)
     result = pd.DataFrame(result)
-    # remove instances with tokens that disagree or have no values for all
-    # four features.
-    features = ["number", "gender", "case", "person"]
-    agree = result["agree"]
-    has_no_values = (result[features] == NA).all(axis=1)
-    result = result[agree & ~has_no_values]
-    # order columns
-    cols = [
-        "uid",
-        "lemma",
-        "type",
-        "pos",
-        "number",
-        "gender",
-        "case",
-        "person",
-        "masked",
-        "other_masked",
-        "other_lemma",
-        "intervening_noun",
-        "num_distractors",
-        "correct_form",
-        "other_correct_form",
-    ]
-    return result[cols]
+    # so the columns have the right types even if we found no examples
+    return result.astype({"intervening_noun": bool, "num_distractors": int})
 
 
 def prepare(language):
     """Prepare cloze examples for `language`.
 
     We source cloze examples from the Universal Dependencies corpora for that
-    language.
+    language. The corpus files are independent, so we process them in parallel.
 
     Parameters
     ----------
@@ -404,8 +545,12 @@ def prepare(language):
     """
     pattern = f"UD_{language}*/*.conllu"
     file_names = glob(os.path.join(UNIVERSAL_DEPENDENCIES_DIR, pattern))
-    result = [collect_agreement_relations(fname) for fname in file_names]
+    with Pool() as pool:
+        result = pool.map(collect_agreement_relations, file_names)
     result = pd.concat(result, ignore_index=True, sort=False)
+    # these columns only take a few different values
+    categorical = ["type", "pos"] + FEATURES
+    result[categorical] = result[categorical].astype("category")
     result.drop_duplicates(inplace=True, subset=["masked", "type"])
     # filter out automatically harvested cloze examples that are not valid,
     # because we know that this language doesn't have those agreement relations
@@ -425,8 +570,8 @@ if __name__ == "__main__":
             cloze, total_num, valid_num = prepare(name)
             total += total_num
             valid += valid_num
-            file_name = os.path.join(CLOZE_DIR, f"{code}.csv")
-            cloze.to_csv(file_name, index=False)
+            file_name = os.path.join(CLOZE_DIR, f"{code}.parquet")
+            cloze.to_parquet(file_name, index=False)
             print(f"Prepared cloze examples for {name}")
         except ValueError:  # the pd.concat in `prepare` errored
             print(f"No cloze examples found for {name}")
@@ -0,0 +1,52 @@
+"""Consolidate per-example probability files into one store per language.
+
+Originally we saved the probabilities for each cloze example to its own CSV
+file in a directory per language. The analysis scripts spent most of their
+time opening and parsing these files, so here we gather them into a single
+Parquet file per language (see `utils.ProbabilityStore`). probabilities.py
+now writes these stores directly, so this is only needed for probabilities
+from earlier runs.
+
+This module is intended to be run as a script:
+    $ python src/consolidate.py
+
+"""
+import os
+
+from tqdm import tqdm
+
+from filenames import PROBABILITIES_DIR
+from utils import ProbabilityWriter, probabilities_path, read_probabilities
+
+
+def consolidate(code, reverse=False):
+    """Consolidate the probability files for language `code`.
+
+    Parameters
+    ----------
+    code : str
+        ISO code of the language
+    reverse : bool
+        Whether to consolidate the files for the reverse-masked cloze examples
+
+    Returns
+    -------
+    None
+
+    """
+    prefix = "reverse-" if reverse else ""
+    directory = os.path.join(PROBABILITIES_DIR, code)
+    with ProbabilityWriter(probabilities_path(code, reverse)) as writer:
+        for file_name in tqdm(sorted(os.listdir(directory))):
+            if file_name.startswith("reverse-") != reverse:
+                continue
+            uid = file_name[len(prefix) : -len(".csv")]
+            writer.write(uid, read_probabilities(os.path.join(directory, file_name)))
+
+
+if __name__ == "__main__":
+    for code in sorted(os.listdir(PROBABILITIES_DIR)):
+        if os.path.isdir(os.path.join(PROBABILITIES_DIR, code)):
+            consolidate(code)
+            consolidate(code, reverse=True)
+            print(f"Consolidated probabilities for {code}")
@@ -6,22 +6,26 @@ This module is intended to be run as a script:
 """
 import os
 
+import numpy as np
 import pandas as pd
+import torch
 
 from bert import BERT
-from constants import LANGUAGES, MASK, MISSING
-from filenames import CLOZE_DIR, EXPERIMENTS_DIR, FEATURES_DIR
-from utils import refresh
+from constants import LANGUAGES, MASK
+from filenames import CACHE_DIR, CLOZE_DIR, EXPERIMENTS_DIR, FEATURES_DIR
 
 ENGLISH_MODEL = "bert-base-cased"
 MULTILINGUAL_MODEL = "bert-base-multilingual-cased"
+BATCH_SIZE = 64  # number of cloze examples to predict at once
 
 
 def index_of_masked_word(sentence, bert):
     """Return index of the masked word in `sentence` using `bert`'s' tokenizer.
 
     We use this function to calculate the linear distance between the target
-    and controller as BERT sees it.
+    and controller as BERT sees it. MASK is never split by the tokenizer, so
+    its index is the number of tokens before it and we only need to tokenize
+    that part of the sentence.
 
     Parameters
     ----------
@@ -32,16 +36,88 @@ def index_of_masked_word(sentence, bert):
     int
 
     """
-    tokens = bert.tokenize(sentence)
-    try:
-        return tokens.index(MASK)
-    except ValueError:  # MASK not in sentence
+    if MASK not in sentence:
         return -1
+    prefix = sentence[: sentence.index(MASK)]
+    return len(bert.tokenize(prefix))
 
 
-def run(language, force_multilingual=False, fold_case=True, gpu=True):
+def vocab_features(code, model, vocab, fold_case):
+    """Return the features of the words of language `code` that are in `vocab`.
+
+    Reading and filtering the features is slow for languages with a lot of
+    them, so we cache the result for each language, model and casing. The
+    cache is rebuilt whenever the features are.
+
+    Parameters
+    ----------
+    code : str
+        ISO code of the language
+    model : str
+        Name of the BERT model that `vocab` belongs to
+    vocab : list of str
+    fold_case : bool
+        Whether to compare words with the lowercased `vocab`
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    features_filename = os.path.join(FEATURES_DIR, f"{code}.parquet")
+    casing = "folded" if fold_case else "cased"
+    model = model.replace(os.sep, "-")
+    cache_filename = os.path.join(CACHE_DIR, f"{code}-{model}-{casing}.parquet")
+    if os.path.exists(cache_filename) and (
+        os.path.getmtime(cache_filename) >= os.path.getmtime(features_filename)
+    ):
+        return pd.read_parquet(cache_filename)
+    features = pd.read_parquet(features_filename)
+    if fold_case:
+        vocab = frozenset(word.lower() for word in vocab)
+    else:
+        vocab = frozenset(vocab)
+    # remove any words that aren't in the vocab
+    features = features[features["word"].isin(vocab)]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    features.to_parquet(cache_filename, index=False)
+    return features
+
+
+def mean_or_zero(values):
+    """Return the mean of `values`, or zero if there aren't any.
+
+    As in pandas, NaNs are skipped, so the mean is NaN only if all the values
+    are NaN.
+
+    Parameters
+    ----------
+    values : np.ndarray
+
+    Returns
+    -------
+    float
+
+    """
+    if len(values) == 0:
+        return 0.0
+    values = values[~np.isnan(values)]
+    return values.mean() if len(values) else np.nan
+
+
+@torch.inference_mode()
+def run(
+    language,
+    force_multilingual=False,
+    fold_case=True,
+    gpu=True,
+    bf16=False,
+    quantize=False,
+):
     """Run the experiment for `language`.
 
+    No gradients are needed anywhere in here, so we run in inference mode.
+
     Parameters
     ----------
     language : str
@@ -51,6 +127,11 @@ def run(language, force_multilingual=False, fold_case=True, gpu=True):
         Whether to ignore caseing differences after making predictions
     gpu : bool
         Whether to run on GPU or not (useful for debugging)
+    bf16 : bool
+        Whether to run BERT in bfloat16 rather than float16 on GPU
+    quantize : bool
+        Whether to quantize BERT to int8 on CPU, which is faster but changes
+        the probabilities slightly
 
     Returns
     -------
@@ -58,77 +139,87 @@ def run(language, force_multilingual=False, fold_case=True, gpu=True):
 
     """
     if (language == "English") and (not force_multilingual):
-        bert = BERT(ENGLISH_MODEL, gpu=gpu)
+        model = ENGLISH_MODEL
     else:
-        bert = BERT(MULTILINGUAL_MODEL, gpu=gpu)
-    vocab = bert.vocab
-    if fold_case:
-        vocab = [word.lower() for word in vocab]
+        model = MULTILINGUAL_MODEL
+    bert = BERT(model, gpu=gpu, quantize=quantize, bf16=bf16)
     code = LANGUAGES[language]
-    cloze = pd.read_csv(os.path.join(CLOZE_DIR, f"{code}.csv"))
+    cloze = pd.read_parquet(os.path.join(CLOZE_DIR, f"{code}.parquet"))
     num_examples = len(cloze) * 2  # because we mask out both words
     print(f"\n\nNumber of examples for {language}: {num_examples}")
     print_every = num_examples // 100
-    features = pd.read_csv(
-        os.path.join(FEATURES_DIR, f"{code}.csv"), dtype={"person": str}
-    )
-    # remove any words that aren't in the vocab
-    features = features[features["word"].isin(vocab)]
+    features = vocab_features(code, model, bert.vocab, fold_case)
     # if we are masking out the controller, we know that the masked word is
     # also a noun or a pronoun, so we can remove everything else from features
     # features = features[features['pos'].isin(['NOUN', 'PRON'])]
     cols = ["number", "gender", "case", "person"]
-    result = []
+    # we only ever need BERT's predictions of the words we have features for
+    vocab_words = features["word"].unique()
+    # split once here rather than filtering on POS for every example. Words
+    # can have several feature bundles, so we also note which of the unique
+    # words each bundle belongs to, and where those words are in `vocab_words`.
+    features_by_pos = {}
+    for pos, group in features.groupby("pos", observed=True):
+        codes, words = pd.factorize(group["word"])
+        indices = pd.Index(vocab_words).get_indexer(words)
+        features_by_pos[pos] = (codes, indices, group[cols].to_numpy())
+    no_features = (
+        np.array([], dtype=int),
+        np.array([], dtype=int),
+        np.empty((0, len(cols))),
+    )
+    # for each masked sentence, the position of its cloze example and our
+    # results, gathered column by column
+    positions, correct, incorrect, distance = [], [], [], []
     count, total = 0, 0
-    for _, example in cloze.iterrows():
-        for mask in ["masked", "other_masked"]:
-            try:
-                predictions = bert.predict(example[mask], fold_case)
-            except ValueError:  # MASK not in sentence
-                continue
-            predictions = features.merge(
-                predictions, how="left", left_on="word", right_index=True
-            )
+    for start in range(0, len(cloze), BATCH_SIZE):
+        # predict the masked word of every sentence in the batch at once
+        batch = cloze.iloc[start : start + BATCH_SIZE]
+        rows = batch[["pos", "masked", "other_masked"] + cols]
+        examples, sentences = [], []
+        for position, row in enumerate(rows.itertuples(index=False), start):
+            # the linear distance between masked and other word, which is the
+            # same whichever of the two is masked
+            masked_index = index_of_masked_word(row.masked, bert)
+            other_index = index_of_masked_word(row.other_masked, bert)
+            row_distance = abs(masked_index - other_index)
+            for sentence in [row.masked, row.other_masked]:
+                if MASK in sentence:
+                    examples.append((position, row, row_distance))
+                    sentences.append(sentence)
+        predictions = bert.predict_words_batch(sentences, vocab_words, fold_case)
+        for (position, row, row_distance), p in zip(examples, predictions):
+            pos, _, _, *values = row
             # only keep words of the same POS category as the masked word
-            predictions = predictions[predictions["pos"] == example["pos"]]
+            codes, indices, word_values = features_by_pos.get(pos, no_features)
+            p = p[indices]
             # A word is correct if all its features are identical with the features
             # of the masked word.
-            predictions["correct"] = (predictions[cols] == example[cols]).all(axis=1)
+            is_correct = (word_values == np.array(values, dtype=object)).all(axis=1)
             # If a word form has multiple feature bundles and at least one of them
-            # is correct, then we count that word form as correct. The values of
-            # 'p' for the differently valued but identical word forms will be
-            # identical (because BERT predicts word forms). I want to include the
-            # 'p' in the resulting dataframe so I just take the first value.
-            predictions = predictions.groupby("word").agg(
-                {"correct": any, "p": "first"}
-            )
+            # is correct, then we count that word form as correct. BERT predicts
+            # word forms, so each word form has a single 'p'.
+            is_correct = np.bincount(codes, weights=is_correct, minlength=len(indices))
+            is_correct = is_correct > 0
             # we compute the average (unnormalized) probability of all the word
             # forms BERT got correct and all it got incorrect.
-            mean = predictions.groupby("correct")["p"].mean()
-            try:
-                example["correct"] = mean[True]
-            except KeyError:
-                example["correct"] = 0.0
-            try:
-                example["incorrect"] = mean[False]
-            except KeyError:
-                example["incorrect"] = 0.0
-            # add in the linear distance between masked and other word
-            masked_index = index_of_masked_word(example["masked"], bert)
-            other_index = index_of_masked_word(example["other_masked"], bert)
-            example["distance"] = abs(masked_index - other_index)
-            result.append(example)
-            if example["correct"] > example["incorrect"]:
+            positions.append(position)
+            correct.append(mean_or_zero(p[is_correct]))
+            incorrect.append(mean_or_zero(p[~is_correct]))
+            distance.append(row_distance)
+            if correct[-1] > incorrect[-1]:
                 count += 1
             total += 1
             if total % print_every == 0:
                 percent_correct = round(100 * (count / total), 3)
                 percent_done = round(100 * (total / num_examples), 3)
                 print(f"{percent_correct}% correct with {percent_done}% done")
-    result = pd.DataFrame(result)
+    result = cloze.iloc[positions].assign(
+        correct=correct, incorrect=incorrect, distance=distance
+    )
     result["right"] = result["correct"] > result["incorrect"]
-    file_name = os.path.join(EXPERIMENTS_DIR, f"{code}.csv")
-    result.to_csv(file_name, index=False)
+    file_name = os.path.join(EXPERIMENTS_DIR, f"{code}.parquet")
+    result.to_parquet(file_name, index=False)
     return result
 
 
@@ -136,7 +227,7 @@ if __name__ == "__main__":
     #  #   # refresh(EXPERIMENTS_DIR)  # don't uncomment me!
     #     # run experiments for languages with fewer cloze examples first
     #     ORDER = {
-    #         language: len(pd.read_csv(os.path.join(CLOZE_DIR, f'{code}.csv')))
+    #         language: len(pd.read_parquet(os.path.join(CLOZE_DIR, f'{code}.parquet')))
     #         for language, code in LANGUAGES.items()
     #     }
     ORDER = {"Czech": 0, "German": 1}
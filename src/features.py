@@ -8,17 +8,20 @@ This module is intended to be run as a script:
     $ python src/features.py
 
 """
+import csv
 import os
+import sys
 from glob import glob
+from multiprocessing import Pool
 
 import pandas as pd
-import pyconll
 
 from constants import LANGUAGES, NA
 from filenames import FEATURES_DIR, UNIMORPH_DIR, UNIVERSAL_DEPENDENCIES_DIR
 from utils import refresh
 
 COLS = ["lemma", "word", "pos", "number", "gender", "case", "person"]
+EMPTY = "_"  # how CoNLL-U marks an empty field
 
 # Preparing features from UniMorph
 
@@ -29,13 +32,14 @@ def make_mapper(mapping):  # noqa: D202
     The Universal Dependencies and UniMorph data use different annotation
     schemas. We need to convert one schema to another. There's a great project
     by Arya McCarthy on converting from the Universal Dependencies schema to
-    the UniMorph one, but another library I rely on (pyconll) needs them in
-    the original schema. I use the Universal Dependencies data in more places
+    the UniMorph one, but I read the Universal Dependencies data in its
+    original schema. I use the Universal Dependencies data in more places
     than the UniMorph data, so in my case it makes more sense to convert from
     UniMorph to Universal Dependencies.
 
     Given a set of UniMorph feature values, the returned function looks for
-    values that it can map, but returns NA if it doesn't find any.
+    values that it can map, but returns NA if it doesn't find any. If it finds
+    more than one, the one that comes first in `mapping` wins.
 
     Parameters
     ----------
@@ -48,11 +52,14 @@ def make_mapper(mapping):  # noqa: D202
 
     """
 
+    keys = frozenset(mapping)
+    rank = {key: i for i, key in enumerate(mapping)}
+
     def func(features):
-        for feature in features:
-            if feature in mapping:
-                return mapping[feature]
-        return NA
+        found = keys.intersection(features)
+        if not found:
+            return NA
+        return mapping[min(found, key=rank.get)]
 
     return func
 
@@ -70,6 +77,7 @@ POS_MAPPING = {
     "DET": "DET",
     "AUX": "AUX",
 }
+POS_OF_INTEREST = frozenset(POS_MAPPING.values())
 NUMBER_MAPPING = {"SG": "Sing", "PL": "Plur"}
 GENDER_MAPPING = {"MASC": "Masc", "FEM": "Fem", "NEUT": "Neut"}
 # we restrict our attention to the core case values
@@ -82,6 +90,15 @@ map_gender = make_mapper(GENDER_MAPPING)
 map_case = make_mapper(CASE_MAPPING)
 map_person = make_mapper(PERSON_MAPPING)
 
+# the column each mapper fills in
+MAPPERS = {
+    "pos": map_pos,
+    "number": map_number,
+    "gender": map_gender,
+    "case": map_case,
+    "person": map_person,
+}
+
 
 def prepare_um(language):
     """Prepare word feature values from `language` from UniMorph data.
@@ -102,20 +119,25 @@ def prepare_um(language):
     """
     code = LANGUAGES[language]
     file_name = os.path.join(UNIMORPH_DIR, code, code)
-    result = []
-    with open(file_name) as file:
-        for line in file:
-            if line.split():
-                lemma, inflected, features = line.strip().split("\t")
-                features = set(features.split(";"))
-                data = {"word": inflected, "lemma": lemma}
-                data["pos"] = map_pos(features)
-                data["number"] = map_number(features)
-                data["gender"] = map_gender(features)
-                data["case"] = map_case(features)
-                data["person"] = map_person(features)
-                result.append(data)
-    return pd.DataFrame(result)
+    result = pd.read_csv(
+        file_name,
+        sep="\t",
+        names=["lemma", "word", "features"],
+        dtype=str,
+        quoting=csv.QUOTE_NONE,
+        keep_default_na=False,  # words like "null" aren't missing values
+    )
+    result = result.dropna(subset=["features"])  # lines of only whitespace
+    bundles = result["features"].str.strip()
+    # there are far fewer distinct feature bundles than lines, so we map each
+    # bundle once rather than once per line
+    unique_bundles = bundles.unique()
+    feature_sets = [set(bundle.split(";")) for bundle in unique_bundles]
+    result["lemma"] = result["lemma"].str.strip()
+    for column, mapper in MAPPERS.items():
+        mapping = dict(zip(unique_bundles, map(mapper, feature_sets)))
+        result[column] = bundles.map(mapping)
+    return result[["word", "lemma"] + list(MAPPERS)].reset_index(drop=True)
 
 
 # Preparing features from UD
@@ -127,9 +149,73 @@ POSSIBLE_FEATURE_VALUES = set(
     + list(PERSON_MAPPING.values())
 )
 
+# what each of the features is called in the Universal Dependencies data
+UD_FEATURE_NAMES = {
+    "number": "Number",
+    "gender": "Gender",
+    "case": "Case",
+    "person": "Person",
+}
+
+
+def read_ud_tokens(fname):
+    """Yield the form, lemma, POS and features of each token in `fname`.
 
-def feature_value(token, feature):
-    """Return the value of `feature` in `token`.
+    We only need a few fields of each token, so rather than have a CoNLL-U
+    library build an object for every token and sentence, we split the lines
+    of the file ourselves. As in pyconll, empty fields are None, unless both
+    form and lemma are empty, in which case the word really is an underscore.
+    The features are left as they are in the file, so that they're only
+    parsed for the tokens we need (see `parse_feats()`).
+
+    Parameters
+    ----------
+    fname : str
+
+    Yields
+    ------
+    tuple of str
+        The form, lemma, POS and features of the token
+
+    """
+    with open(fname, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if (not line) or line.startswith("#"):  # between sentences
+                continue
+            fields = line.split("\t")
+            form, lemma, upos, feats = fields[1], fields[2], fields[3], fields[5]
+            if (form != EMPTY) or (lemma != EMPTY):
+                form = None if form == EMPTY else form
+                lemma = None if lemma == EMPTY else lemma
+            yield form, lemma, (None if upos == EMPTY else upos), feats
+
+
+def parse_feats(feats):
+    """Return the features in the CoNLL-U FEATS field `feats`.
+
+    As in pyconll, the values of each feature are a set.
+
+    Parameters
+    ----------
+    feats : str
+
+    Returns
+    -------
+    dict(str : set of str)
+
+    """
+    if feats == EMPTY:
+        return {}
+    result = {}
+    for pair in feats.split("|"):
+        feature, _, values = pair.partition("=")
+        result[feature] = set(values.split(","))
+    return result
+
+
+def feature_value(feats, feature):
+    """Return the value of `feature` in a token's features `feats`.
 
     The token may not have a value for the feature, either because the
     language doesn't mark that feature on this kind of token, or because
@@ -137,22 +223,23 @@ def feature_value(token, feature):
 
     Parameters
     ----------
-    token : pyconll Token
+    feats : dict(str : set of str)
+        The token's features, as returned by `parse_feats()`
     feature : str
+        One of the keys of UD_FEATURE_NAMES
 
     Returns
     -------
     str
 
     """
-    feature = feature.title()
-    try:
-        value = str(next(iter(token.feats[feature])))
-        if value in POSSIBLE_FEATURE_VALUES:
-            return value
-        return NA
-    except KeyError:
+    values = feats.get(UD_FEATURE_NAMES[feature])
+    if values is None:
         return NA
+    value = next(iter(values))
+    if value in POSSIBLE_FEATURE_VALUES:
+        return sys.intern(value)  # so comparing values is cheap
+    return NA
 
 
 def prepare_one_ud_file(fname):
@@ -171,17 +258,17 @@ def prepare_one_ud_file(fname):
         Contains columns for word form, pos, number, gender, case and person
 
     """
-    conll = pyconll.iter_from_file(fname)
-    result = []
-    pos_of_interest = set(POS_MAPPING.values())
-    for sentence in conll:
-        for token in sentence:
-            pos = token.upos
-            if pos in pos_of_interest:
-                data = {"word": token.form, "pos": pos, "lemma": token.lemma}
-                for feature in ["number", "gender", "case", "person"]:
-                    data[feature] = feature_value(token, feature)
-                result.append(data)
+    features = ["number", "gender", "case", "person"]
+    # built up column by column, rather than as one dict per token
+    result = {column: [] for column in ["word", "pos", "lemma"] + features}
+    for form, lemma, pos, feats in read_ud_tokens(fname):
+        if pos in POS_OF_INTEREST:
+            feats = parse_feats(feats)
+            result["word"].append(form)
+            result["pos"].append(pos)
+            result["lemma"].append(lemma)
+            for feature in features:
+                result[feature].append(feature_value(feats, feature))
     return pd.DataFrame(result)
 
 
@@ -201,10 +288,11 @@ def prepare_ud(language):
     """
     pattern = os.path.join(UNIVERSAL_DEPENDENCIES_DIR, "**/*.conllu")
     file_names = [f for f in glob(pattern, recursive=True) if language in f]
-    result = []
-    for file_name in file_names:
-        features = prepare_one_ud_file(file_name)
-        result.append(features)
+    # the files are independent, so we process them in parallel
+    with Pool() as pool:
+        result = pool.map(prepare_one_ud_file, file_names)
+    if len(result) == 1:  # concatenating would only copy it
+        return result[0]
     if result:
         return pd.concat(result, ignore_index=True, sort=False)
     return pd.DataFrame([], columns=COLS)
@@ -242,25 +330,33 @@ def prepare(language):
     ud = prepare_ud(language)
     try:
         um = prepare_um(language)
-        result = pd.concat([ud, um], ignore_index=True, sort=False)
     except FileNotFoundError:  # No UniMorph data for this language
+        um = None
+    # concatenating copies both frames, so we don't if one of them is empty
+    if (um is None) or um.empty:
         result = ud
+    elif ud.empty:
+        result = um
+    else:
+        result = pd.concat([ud, um], axis=0, ignore_index=True, sort=False)
     result["word"] = result["word"].str.lower()
     result["person"] = result["person"].astype(str)
-    result.drop_duplicates(inplace=True)
-    # drop rows with missing words
-    result.dropna(subset=["word", "pos"], how="any", inplace=True)
-    # drop rows with no feature values in all four features
     features = ["number", "gender", "case", "person"]
-    has_no_values = (result[features] == NA).all(axis=1)
-    result = result[~has_no_values]
-    return result[COLS]
+    # these columns only take a few different values, so as categoricals they
+    # take up less space and comparing them compares integer codes
+    categorical = ["pos"] + features
+    result[categorical] = result[categorical].astype("category")
+    # drop rows with missing words, and rows with no feature values in all
+    # four features, in one pass before dropping duplicates
+    is_valid = result["word"].notna() & result["pos"].notna()
+    is_valid &= ~(result[features] == NA).all(axis=1)
+    return result.loc[is_valid, COLS].drop_duplicates()
 
 
 if __name__ == "__main__":
     refresh(FEATURES_DIR)
     for name, code in LANGUAGES.items():
         features = prepare(name)
-        file_name = os.path.join(FEATURES_DIR, f"{code}.csv")
-        features.to_csv(file_name, index=False)
+        file_name = os.path.join(FEATURES_DIR, f"{code}.parquet")
+        features.to_parquet(file_name, index=False)
         print(f"Prepared features for {name}")
@@ -6,3 +6,4 @@ FEATURES_DIR = "data/features"
 CLOZE_DIR = "data/cloze"
 EXPERIMENTS_DIR = "data/experiments"
 PROBABILITIES_DIR = "data/probabilities"
+CACHE_DIR = "data/cache"
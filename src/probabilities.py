@@ -5,21 +5,37 @@ This module is intended to be run as a script:
 
 """
 import os
+from collections import OrderedDict
 
 import pandas as pd
+import pyarrow as pa
+import torch
 from tqdm import tqdm
 
 from bert import BERT
-from constants import LANGUAGES, MASK, MISSING
+from constants import LANGUAGES, MASK
 from filenames import CLOZE_DIR, FEATURES_DIR, PROBABILITIES_DIR
+from utils import ProbabilityWriter, probabilities_path
 
 ENGLISH_MODEL = "bert-base-cased"
 MULTILINGUAL_MODEL = "bert-base-multilingual-cased"
+BATCH_SIZE = 64  # number of cloze examples to predict at once
+CACHE_SIZE = 1024  # number of recent predictions to keep for reuse
 
 
-def run(language, force_multilingual=False, fold_case=True, gpu=True):
+@torch.inference_mode()
+def run(
+    language,
+    force_multilingual=False,
+    fold_case=True,
+    gpu=True,
+    bf16=False,
+    quantize=False,
+):
     """Get predicted words cloze examples for `language`.
 
+    No gradients are needed anywhere in here, so we run in inference mode.
+
     Parameters
     ----------
     language : str
@@ -29,62 +45,87 @@ def run(language, force_multilingual=False, fold_case=True, gpu=True):
         Whether to ignore caseing differences after making predictions
     gpu : bool
         Whether to run on GPU or not (useful for debugging)
-
-    Returns
-    -------
-    pd.DataFrame
+    bf16 : bool
+        Whether to run BERT in bfloat16 rather than float16 on GPU
+    quantize : bool
+        Whether to quantize BERT to int8 on CPU, which is faster but changes
+        the probabilities slightly
 
     """
     if (language == "English") and (not force_multilingual):
-        bert = BERT(ENGLISH_MODEL, gpu=gpu)
+        bert = BERT(ENGLISH_MODEL, gpu=gpu, quantize=quantize, bf16=bf16)
     else:
-        bert = BERT(MULTILINGUAL_MODEL, gpu=gpu)
+        bert = BERT(MULTILINGUAL_MODEL, gpu=gpu, quantize=quantize, bf16=bf16)
     vocab = bert.vocab
     if fold_case:
         vocab = [word.lower() for word in vocab]
     code = LANGUAGES[language]
-    cloze = pd.read_csv(os.path.join(CLOZE_DIR, f"{code}.csv"))
+    cloze = pd.read_parquet(os.path.join(CLOZE_DIR, f"{code}.parquet"))
     num_examples = len(cloze)
     print(f"\n\nNumber of examples for {language}: {num_examples}")
-    print_every = num_examples // 100
-    features = pd.read_csv(
-        os.path.join(FEATURES_DIR, f"{code}.csv"), dtype={"person": str}
-    )
-    features_vocab = set(features["word"])
-    cols = ["number", "gender", "case", "person"]
-    result = []
-    os.makedirs(os.path.join(PROBABILITIES_DIR, code), exist_ok=True)
-    for _, example in tqdm(cloze.iterrows()):
-        # guard against inputs too long for this implementation
-        length = len(bert.tokenize(example["masked"]))
-        if length > 512:
-            continue
-        for mask in ["masked", "other_masked"]:
-            try:
-                predictions = bert.predict(example[mask], fold_case)
-            except ValueError:  # MASK not in sentence
-                continue
-            # drop words we don't have features for
-            predictions = predictions[predictions.index.isin(features_vocab)]
-            file_name = f'{example["uid"]}.csv'
-            if mask == "other_masked":
-                file_name = "reverse-" + file_name
-            file_name = os.path.join(PROBABILITIES_DIR, code, file_name)
-            predictions.to_csv(file_name)
+    features = pd.read_parquet(os.path.join(FEATURES_DIR, f"{code}.parquet"))
+    features_vocab = pd.Index(features["word"].unique())
+    # the words in BERT's vocab that we have features for. These are the only
+    # ones we need, so they're all we get predictions for from BERT.
+    words = pd.Index(vocab).unique()
+    words = words[words.isin(features_vocab)]
+    # every prediction is of the same words, so we convert them for storing
+    # once and store each prediction as is, without building a DataFrame
+    stored_words = pa.array(words)
+    os.makedirs(PROBABILITIES_DIR, exist_ok=True)
+    # pull out the columns we need once, rather than building a Series per row
+    uids = cloze["uid"].to_numpy()
+    masked = cloze["masked"].to_numpy()
+    other_masked = cloze["other_masked"].to_numpy()
+    # all the probabilities for a language go in one store, rather than a
+    # small file per cloze example (see `utils.ProbabilityStore`)
+    path, reverse_path = probabilities_path(code), probabilities_path(code, True)
+    # the same masked sentence often turns up in neighbouring cloze examples
+    # (e.g. a noun masked out as the controller of both its determiner and its
+    # adjective), so we keep recent predictions around to reuse
+    cache = OrderedDict()
+    with ProbabilityWriter(path) as forward, ProbabilityWriter(reverse_path) as reverse:
+        for start in tqdm(range(0, len(cloze), BATCH_SIZE)):
+            # predict the masked word of every new sentence in the batch at once
+            examples, sentences = [], {}
+            for i in range(start, min(start + BATCH_SIZE, len(cloze))):
+                # guard against inputs too long for this implementation. We keep
+                # the tokens so that BERT doesn't have to tokenize them again.
+                tokens = bert.tokenize(masked[i])
+                if len(tokens) > 512:
+                    continue
+                other_tokens = bert.tokenize(other_masked[i])
+                for store, sentence in [(forward, tokens), (reverse, other_tokens)]:
+                    if MASK not in sentence:
+                        continue
+                    key = tuple(sentence)
+                    examples.append((store, uids[i], key))
+                    if key not in cache:
+                        sentences[key] = sentence
+            predictions_batch = bert.predict_words_tokens_batch(
+                list(sentences.values()), words, fold_case
+            )
+            for key, p in zip(sentences, predictions_batch):
+                cache[key] = p
+            for store, uid, key in examples:
+                store.write_arrays(uid, stored_words, cache[key])
+                cache.move_to_end(key)
+            while len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
 
 
 if __name__ == "__main__":
     # get probabilities for languages with fewer cloze examples first
     already_done = ["bre", "hun", "hye", "tam", "tel", "tur"]
     ORDER = {
-        language: len(pd.read_csv(os.path.join(CLOZE_DIR, f"{code}.csv")))
+        language: len(pd.read_parquet(os.path.join(CLOZE_DIR, f"{code}.parquet")))
         for language, code in LANGUAGES.items()
         if code not in already_done
     }
     ORDER = {"Czech": 0, "German": 1}
     for language in sorted(ORDER, key=ORDER.get):
         try:
-            result = run(language)
+            run(language)
             print(f"Finished with {language}")
         except:  # noqa
             print(f"Error with {language}")
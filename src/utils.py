@@ -2,6 +2,15 @@
 import os
 import shutil
 
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from filenames import PROBABILITIES_DIR
+
+# columns of the Parquet files we store BERT's probabilities in
+SCHEMA = pa.schema([("uid", pa.string()), ("word", pa.string()), ("p", pa.float64())])
+
 
 def refresh(path):
     """Create brand spanking new directory at `path`.
@@ -19,3 +28,180 @@ def refresh(path):
     if os.path.isdir(path):
         shutil.rmtree(path)
     os.makedirs(path)
+
+
+def read_probabilities(path):
+    """Read the probabilities BERT assigned to words from the CSV at `path`.
+
+    The analysis scripts read one of these files per cloze example, so we use
+    pyarrow's CSV reader, which parses them several times faster than pandas.
+    BERT's vocab includes words like "nan" and "NA", so we read every word as
+    it is rather than as null.
+
+    Parameters
+    ----------
+    path : str
+        Path of the probabilities file
+
+    Returns
+    -------
+    pd.DataFrame
+        Contains columns for word and p
+
+    """
+    options = pacsv.ConvertOptions(
+        column_types={"word": pa.string()}, null_values=[], strings_can_be_null=False
+    )
+    return pacsv.read_csv(path, convert_options=options).to_pandas()
+
+
+def probabilities_path(code, reverse=False):
+    """Return the path of the probabilities store for language `code`.
+
+    Parameters
+    ----------
+    code : str
+        ISO code of the language
+    reverse : bool
+        Whether to return the store for the reverse-masked cloze examples
+
+    Returns
+    -------
+    str
+
+    """
+    prefix = "reverse-" if reverse else ""
+    return os.path.join(PROBABILITIES_DIR, f"{prefix}{code}.parquet")
+
+
+def stored_languages():
+    """Return the codes of all languages with a probabilities store.
+
+    Returns
+    -------
+    list of str
+
+    """
+    suffix = ".parquet"
+    return [
+        file_name[: -len(suffix)]
+        for file_name in sorted(os.listdir(PROBABILITIES_DIR))
+        if file_name.endswith(suffix) and not file_name.startswith("reverse-")
+    ]
+
+
+class ProbabilityStore:
+    """Read-only access to the probabilities of a language's cloze examples.
+
+    All the probabilities for a language live in a single Parquet file, with
+    one row group per cloze example. Opening tens of thousands of small files
+    was the bottleneck in the analysis scripts, so instead we open this file
+    once and read the row group for a cloze example when we need it.
+
+    """
+
+    def __init__(self, path):
+        """Initialize ProbabilityStore instance.
+
+        Parameters
+        ----------
+        path : str
+            Path of the store, as returned by `probabilities_path()`
+
+        """
+        self.file = pq.ParquetFile(path)
+        metadata = self.file.metadata
+        column = self.file.schema_arrow.get_field_index("uid")
+        # each row group holds a single uid, so its min statistic is the uid
+        self.row_groups = {
+            metadata.row_group(i).column(column).statistics.min: i
+            for i in range(metadata.num_row_groups)
+        }
+
+    def __contains__(self, uid):
+        """Return True if there are probabilities for cloze example `uid`."""
+        return str(uid) in self.row_groups
+
+    def __getitem__(self, uid):
+        """Return the probabilities for cloze example `uid`.
+
+        Raises KeyError if we skipped this cloze example.
+
+        Parameters
+        ----------
+        uid : str
+
+        Returns
+        -------
+        pd.DataFrame
+            Contains columns for word and p
+
+        """
+        row_group = self.row_groups[str(uid)]
+        return self.file.read_row_group(row_group, columns=["word", "p"]).to_pandas()
+
+
+class ProbabilityWriter:
+    """Write the probabilities of a language's cloze examples to a store.
+
+    Use as a context manager so that the file is closed properly.
+
+    """
+
+    def __init__(self, path):
+        """Initialize ProbabilityWriter instance.
+
+        Parameters
+        ----------
+        path : str
+            Path of the store, as returned by `probabilities_path()`
+
+        """
+        self.writer = pq.ParquetWriter(path, SCHEMA)
+
+    def __enter__(self):
+        """Return this writer."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the underlying file."""
+        self.writer.close()
+
+    def write(self, uid, probs):
+        """Write `probs` for cloze example `uid` as its own row group.
+
+        Parameters
+        ----------
+        uid : str
+        probs : pd.DataFrame
+            Contains columns for word and p
+
+        Returns
+        -------
+        None
+
+        """
+        self.write_arrays(uid, probs["word"], probs["p"])
+
+    def write_arrays(self, uid, words, p):
+        """Write the probabilities `p` of `words` for cloze example `uid`.
+
+        This is like `write()` without building a DataFrame. When the same
+        words are written over and over, pass them as a pyarrow array so they
+        only need converting once.
+
+        Parameters
+        ----------
+        uid : str
+        words : pa.Array or array-like of str
+        p : array-like of float
+
+        Returns
+        -------
+        None
+
+        """
+        if len(p) == 0:  # nothing to look up later, so don't store it
+            return
+        table = {"uid": pa.repeat(str(uid), len(p)), "word": words, "p": p}
+        self.writer.write_table(pa.table(table, schema=SCHEMA))